@@ -33,6 +33,7 @@ class Agent(nn.Module):
         else:
             latent, action = prev_state
 
+        obs = self._preprocess(obs)
         obs = self.encoder(obs)
         latent, _ = self.wm.obs_step(obs, action, latent)
         feat = self.wm.get_feat(latent)
@@ -49,6 +50,7 @@ class Agent(nn.Module):
         # todo discounts, burn_in, truncate properly, separate_kl, categorical latent
         #   gumbel, target_ntwotrk, reinforce gradients, entropy, layer norm
         self._model_params.requires_grad_(True)
+        observations = self._preprocess(observations)
         observations_emb = self.encoder(observations)
 
         posts, priors = self.wm.observe(observations_emb, actions, states[0])
@@ -137,6 +139,13 @@ class Agent(nn.Module):
         actions = torch.stack(actions)
         return self.wm.get_feat(states), actions
 
+    @staticmethod
+    def _preprocess(obs):
+        # pixels are stored as uint8
+        if obs.dtype == torch.uint8:
+            obs = obs.float().div_(255.)
+        return obs
+
     def masked_discount(self, x, mask_size):
         mask = torch.cat([torch.zeros(mask_size, device=self.device),
                           torch.ones(x.size(0) - mask_size, device=self.device)])
@@ -131,7 +131,7 @@ class PointCloudGenerator:
         self.fovy = math.radians(camera_fovy)
         self.height = image_height
         self.width = image_width
-        self.device = device
+        self.device = torch.device(device)
 
         if rot_matrix != None:
             self.rot_matrix = torch.tensor(rot_matrix, dtype=torch.float32, device=device, requires_grad=False)
@@ -149,14 +149,14 @@ class PointCloudGenerator:
         self.cx = self.cam_matrix[0, 2]
         self.cy = self.cam_matrix[1, 2]
 
-        self.uv1 = torch.ones((self.height, self.width, 3), dtype=torch.float32, device=device, requires_grad=False)
-        for i in range(self.height):
-            for j in range(self.width):
-                self.uv1[i][j][0] = ((i + 1) - self.cx) / self.fx
-                self.uv1[i][j][1] = ((j + 1) - self.cy) / self.fy
-        #print(self.uv1.shape)
-        self.uv1 = self.uv1.reshape(-1, 3)
-        #   print(self.uv1.shape)
+        # unprojection rays are fixed by the intrinsics, so they are built once;
+        # rows are flipped here so rendered depth (bottom-up) needs no flip per frame
+        rows = torch.arange(1, self.height + 1, dtype=torch.float32, device=device)
+        cols = torch.arange(1, self.width + 1, dtype=torch.float32, device=device)
+        rows, cols = torch.meshgrid(rows, cols, indexing='ij')
+        self.uv1 = torch.stack([(rows - self.cx) / self.fx, (cols - self.cy) / self.fy,
+                                torch.ones_like(rows)], -1)
+        self.uv1 = self.uv1.flip(0).reshape(-1, 3)
 
     def get_cam_matrix(self):
         f = self.height / (2 * math.tan(self.fovy / 2))
@@ -165,14 +165,16 @@ class PointCloudGenerator:
                             dtype=torch.float32, device=self.device, requires_grad=False)
 
     def reshape_depth(self, depth):
-        depth = torch.tensor(np.flip(depth, axis=0).copy(), dtype=torch.float32, device=self.device,
-                             requires_grad=False)
-        depth = depth.reshape(-1, 1)
-        return torch.cat((depth, depth, depth), dim=-1)
+        depth = torch.as_tensor(depth, dtype=torch.float32, device=self.device)
+        return depth.reshape(-1, 1)
 
-    def get_PC(self, depth):
+    def get_PC(self, depth, mask=None):
         depth = self.reshape_depth(depth)
-        xyz = depth * self.uv1
+        if mask is None:
+            return depth * self.uv1
+        # unproject only the valid pixels
+        ind = torch.nonzero(mask.reshape(-1)).squeeze(-1)
+        xyz = depth[ind] * self.uv1[ind]
         return xyz
 
 
@@ -1,25 +1,50 @@
 import numpy as np
 import gym
-from gym.spaces import Box
+from gym.spaces import Box, Tuple
 import torch
 from .utils import PointCloudGenerator
 import ctypes
+from functools import partial
+from collections import OrderedDict
 from dm_control.mujoco.wrapper import MjvOption
 from dm_control.suite.wrappers import pixels
 
+_MJV_FLAGS = ctypes.c_uint8*22  # zero-initialized on instantiation
 
-class Wrapper:
+
+@torch.jit.script
+def _segment(pc: torch.Tensor, ind_buf: torch.Tensor, arange: torch.Tensor) -> torch.Tensor:
+    # fixed-size output: random subsample of a large cloud or zero padding of a small one
+    amount = pc.size(-2)
+    points = arange.size(0)
+    if amount > points:
+        # sampling with replacement: no need to permute the whole cloud
+        return pc.index_select(-2, ind_buf.random_(0, amount))
+    if amount == points:
+        return pc
+    if amount == 0:
+        return pc.new_zeros((points, pc.size(-1)))
+    pc = pc.index_select(-2, arange.clamp(max=amount - 1))
+    return pc.masked_fill((arange >= amount).unsqueeze(-1), 0.)
+
+
+class Wrapper(gym.Env):
     """ Partially solves problem with  compatibility"""
 
     def __init__(self, env):
         self.env = env
-        self._observation_space, self._action_space = self._infer_spaces(env)
+        self.observation_space, self.action_space, self._keys = self._infer_spaces(env)
+        self._obs_dtype = self.observation_space.dtype
+        # frequently used attributes are delegated explicitly, __getattr__ stays as fallback
+        self._physics = env.physics
+        self._action_spec = env.action_spec()
 
     def observation(self, timestamp):
         return timestamp
 
     def reward(self, timestamp):
-        return np.float32(timestamp.reward)
+        # cast to float32 once per action in FrameSkip
+        return timestamp.reward
 
     def done(self, timestamp):
         return timestamp.last()
@@ -29,7 +54,7 @@ class Wrapper:
         obs = self.observation(timestamp)
         r = self.reward(timestamp)
         d = self.done(timestamp)
-        return obs, r, d, None
+        return obs, r, d, {}
 
     def reset(self):
         return self.observation(self.env.reset())
@@ -40,17 +65,26 @@ class Wrapper:
         spec = env.action_spec()
         action_space = Box(low=spec.minimum.astype(np.float32), dtype=np.float32,
                            high=spec.maximum.astype(np.float32), shape=spec.shape)
-        ar = list(env.observation_spec().values())[0]
-
-        obs_sample = np.concatenate(list(map(lambda ar: ar.generate_value() if ar.shape != () else [1],
-                                             env.observation_spec().values())))
+        # flat layout of the observation dict: scalars take one slot
+        keys = tuple(env.observation_spec().keys())
+        size = sum(max(int(np.prod(ar.shape)), 1) for ar in env.observation_spec().values())
 
-        obs_space = Box(low=-lim, high=lim, shape=obs_sample.shape, dtype=np.float32)#ar.dtype)
-        return obs_space, action_space
+        obs_space = Box(low=-lim, high=lim, shape=(size,), dtype=np.float32)
+        return obs_space, action_space, keys
 
     def __getattr__(self, item):
         return getattr(self.env, item)
 
+    def close(self):
+        return self.env.close()
+
+    def action_spec(self):
+        return self._action_spec
+
+    @property
+    def physics(self):
+        return self._physics
+
     @property
     def unwrapped(self):
         env = self
@@ -58,23 +92,12 @@ class Wrapper:
             env = env.env
         return env
 
-    @property
-    def observation_space(self):
-        return self._observation_space
-
-    @property
-    def action_space(self):
-        return self._action_space
-
 
 class dmWrapper(Wrapper):
     def observation(self, timestamp):
-        obs = np.array([])
-        for v in timestamp.observation.values():
-            if not v.ndim:
-                v = v[None]
-            obs = np.concatenate((obs, v))
-        return obs.astype(np.float32)
+        obs = timestamp.observation
+        # single C-level copy of all parts, cast on the fly
+        return np.concatenate([np.ravel(obs[name]) for name in self._keys], dtype=self._obs_dtype)
 
 
 class FrameSkip(gym.Wrapper):
@@ -83,19 +106,21 @@ class FrameSkip(gym.Wrapper):
         self.fn = frames_number
 
     def step(self, action):
-        R = 0
+        R = 0.
         for i in range(self.fn):
             next_obs, reward, done, info = self.env.step(action)
-            R += reward
+            R += float(reward)
             if done:
                 break
-        return np.float32(next_obs), np.float32(R), done, info
+        return next_obs, np.float32(R), done, info
 
     def reset(self):
-        return np.float32(self.env.reset())
+        return self.env.reset()
 
 
 class depthMapWrapper(Wrapper):
+    dist_thresh = 19  # smth like infty cutting
+    pc_cache_size = 8
 
     def __init__(self, env,
                  camera_id=0,
@@ -104,51 +129,93 @@ class depthMapWrapper(Wrapper):
                  device='cpu',
                  return_pos=False,
                  points=1000,
+                 return_tensor=False,
                  ):
         super().__init__(env)
+        if not points:
+            raise ValueError('depthMapWrapper needs a fixed number of points to declare its observation space')
         self.env = env
         self.points = points
-        self._depth_kwargs = dict(camera_id=camera_id, height=height, width=width,
-                                  depth=True, scene_option=self._prepare_scene())
+        self._height, self._width = height, width
+        self._scene_opt = self._prepare_scene()
+        # physics persists across resets, so its methods can be bound once
+        self._render = partial(self._physics.render, height=height, width=width, camera_id=camera_id,
+                               depth=True, scene_option=self._scene_opt)
+        self._physics_position = self._physics.position
         self.return_pos = return_pos
+        self.return_tensor = return_tensor
+        self.observation_space = Box(low=-np.inf, high=np.inf, shape=(points, 3), dtype=np.float32)
+        if return_pos:
+            pos = np.asarray(self._physics_position())
+            self.observation_space = Tuple((self.observation_space,
+                                            Box(low=-np.inf, high=np.inf, shape=pos.shape, dtype=pos.dtype)))
         self.pcg = PointCloudGenerator(**self.pc_params, device=device)
+        # depth goes to the device through a pinned staging buffer, on cpu it is used directly
+        pin = self.pcg.device.type == 'cuda'
+        self._depth_host = torch.empty((height, width), dtype=torch.float32, pin_memory=pin)
+        self._depth_dev = torch.empty_like(self._depth_host, device=self.pcg.device) if pin else self._depth_host
+        self._depth_out = self._depth_host.numpy()  # shares memory with the staging tensor
+        self._dist_thresh = torch.tensor(float(self.dist_thresh), device=self.pcg.device)
+        self._mask = torch.empty_like(self._depth_dev, dtype=torch.bool)
+        self._ind_buf = torch.empty(points, dtype=torch.long, device=self.pcg.device)
+        self._arange = torch.arange(points, device=self.pcg.device)
+        self._pc_cache = OrderedDict()
 
     def observation(self, timestamp):
-        depth = self.env.physics.render(**self._depth_kwargs)
-        pc = self.pcg.get_PC(depth)
-        pc = self._segmentation(pc)
+        depth = self._render()
+        # identical frames (e.g. idle robot) reuse the last computed clouds;
+        # the cache keeps its own copies so callers may modify what they get
+        key = hash(depth.tobytes())
+        pc = self._pc_cache.get(key)
+        if pc is None:
+            pc = self._point_cloud(depth)
+            self._pc_cache[key] = self._copy(pc)
+            if len(self._pc_cache) > self.pc_cache_size:
+                self._pc_cache.popitem(last=False)
+        else:
+            self._pc_cache.move_to_end(key)
+            pc = self._copy(pc)
         if self.return_pos:
-            pos = self.env.physics.position()
+            pos = self._physics_position()
             return pc, pos
-        return pc.detach().cpu().numpy()
+        return pc
+
+    def reset(self):
+        self._pc_cache.clear()
+        return super().reset()
+
+    def _point_cloud(self, depth):
+        np.copyto(self._depth_out, depth)
+        if self._depth_dev is not self._depth_host:
+            self._depth_dev.copy_(self._depth_host, non_blocking=True)
+        torch.lt(self._depth_dev, self._dist_thresh, out=self._mask)
+        pc = self.pcg.get_PC(self._depth_dev, mask=self._mask)
+        pc = self._segmentation(pc).detach()
+        if self.return_tensor:
+            return pc
+        return pc.cpu().numpy()
+
+    @staticmethod
+    def _copy(pc):
+        return pc.clone() if torch.is_tensor(pc) else pc.copy()
 
     def _segmentation(self, pc):
-        dist_thresh = 19
-        pc = pc[pc[..., 2] < dist_thresh] # smth like infty cutting
-        if self.points:
-            amount = pc.size(-2)
-            if amount > self.points:
-                ind = torch.randperm(amount, device=self.pcg.device)[:self.points]
-                pc = torch.index_select(pc, -2, ind)
-            elif amount < self.points:
-                zeros = torch.zeros(self.points - amount, *pc.shape[1:], device=self.pcg.device)
-                pc = torch.cat([pc, zeros])
-        return pc
+        return _segment(pc, self._ind_buf, self._arange)
 
     def _prepare_scene(self):
         scene = MjvOption()
-        scene.flags = (ctypes.c_uint8*22)(0)
+        scene.flags = _MJV_FLAGS()
 
         return scene
 
     @property
     def pc_params(self):
         # device
-        fovy = self.env.physics.model.cam_fovy[0]
+        fovy = self._physics.model.cam_fovy[0]
         return dict(
             camera_fovy=fovy,
-            image_height=self._depth_kwargs.get('height', 240),
-            image_width=self._depth_kwargs.get('width', 320)
+            image_height=self._height,
+            image_width=self._width
         )
 
 
@@ -156,14 +223,9 @@ class PixelsToGym(Wrapper):
     def __init__(self, env):
         super().__init__(env)
         self.env = pixels.Wrapper(self.env, render_kwargs={'camera_id': 0, 'height': 64, 'width': 64})
+        self.observation_space = Box(low=0, high=255, shape=(3, 64, 64), dtype=np.uint8)
 
     def observation(self, timestamp):
-        obs = timestamp.observation['pixels']
-        obs = np.array(obs) / 255.
-        obs = np.array(obs)
-        return obs.transpose((2, 1, 0))
-
-    @property
-    def observation_space(self):
-        # correspondent space have to be extracted from the dm_control API -> gym API
-        return Box(low=0., high=1., shape=(64, 64, 3))
+        # stored as uint8, scaling to [0, 1] happens on the agent's device
+        obs = np.asarray(timestamp.observation['pixels'])
+        return np.ascontiguousarray(obs.transpose((2, 1, 0)))